@@ -0,0 +1,23 @@
+#!/usr/bin/env python3
+
+"""
+Compiles the dart throwing sampler of generate_problem.py ahead of time into the geo_sampler extension module,
+so command line runs do not have to JIT-compile it first. Requires numba; run it from this directory.
+"""
+
+import warnings
+
+from numba.pycc import CC
+
+with warnings.catch_warnings():
+    # generate_problem warns that geo_sampler is missing, which is what we are about to build
+    warnings.simplefilter('ignore')
+    from generate_problem import _throw_darts
+
+cc = CC('geo_sampler')
+
+# arguments: points to fill, number of points already placed, minimum distance, seed, maximum rejected candidates
+cc.export('throw_darts', 'i8(f8[:,:], i8, f8, i8, i8)')(_throw_darts.py_func)
+
+if __name__ == '__main__':
+    cc.compile()
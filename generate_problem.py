@@ -6,17 +6,188 @@ import numpy as np
 import math
 import networkx as nx
 import matplotlib.pyplot as plt
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
 
 import os
 import csv
 import random
+import warnings
 
 import argparse
 
 from sklearn import preprocessing
 
-def distance(p0, p1):
-    return math.hypot(p1[0] - p0[0], p1[1] - p0[1])
+try:
+    from numba import njit
+    _have_numba = True
+except ImportError:
+    # numba is optional, without it the sampler falls back to _throw_darts_batched
+    _have_numba = False
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+# random source of the sampler. Compiled code keeps its own random state, so seeding np.random there
+# does not touch NumPy's global state; plain Python needs a separate RandomState for that.
+_sampler_random = np.random if _have_numba else np.random.RandomState()
+
+try:
+    # xlsxwriter writes .xlsx files faster than the default openpyxl engine
+    import xlsxwriter
+    _excel_engine = 'xlsxwriter'
+except ImportError:
+    _excel_engine = None
+
+try:
+    # ahead-of-time compiled sampler, built by running _build_ext.py
+    from geo_sampler import throw_darts as _throw_darts_aot
+except ImportError:
+    _throw_darts_aot = None
+    if _have_numba:
+        warnings.warn("geo_sampler extension not built, falling back to the JIT-compiled sampler. Run _build_ext.py to build it.")
+    else:
+        warnings.warn("numba is not installed, falling back to the slower NumPy sampler.")
+
+# shared random number generator, reseeded by the --seed option
+_rng = np.random.default_rng()
+
+@njit(cache=True, fastmath=True)
+def _any_within(pts, head, nxt, gx, gy, cx, cy, min_d2):
+    """
+    Returns whether any point in the 3x3 grid cells around cell (gx, gy) has a squared distance
+    smaller than min_d2 to (cx, cy). The points of a cell are chained from head through nxt.
+    """
+    gsize = head.shape[0]
+    for ix in range(max(gx - 1, 0), min(gx + 2, gsize)):
+        for iy in range(max(gy - 1, 0), min(gy + 2, gsize)):
+            idx = head[ix, iy]
+            while idx >= 0:
+                dx = pts[idx, 0] - cx
+                dy = pts[idx, 1] - cy
+                if dx * dx + dy * dy < min_d2:
+                    return True
+                idx = nxt[idx]
+    return False
+
+@njit(cache=True, fastmath=True)
+def _throw_darts(pts, n_fixed, min_d, seed, max_tries):
+    """
+    Fills pts[n_fixed:] with uniformly random points in the unit square that are at least min_d apart from each
+    other and from pts[:n_fixed]. Candidates are drawn in batches and rejected if they lie too close to a point.
+    Returns the number of points in pts, which is less than len(pts) if max_tries candidates were rejected first.
+    A background grid with cells of side at least min_d means each candidate only has to be checked against the
+    points in the surrounding 3x3 cells (see _any_within). The grid has about one cell per point, so its size
+    does not depend on min_d.
+    The sampler takes a plain integer seed rather than a Generator because the ahead-of-time export in
+    _build_ext.py needs a signature of plain scalar types.
+    """
+    _sampler_random.seed(seed)
+    n_max = pts.shape[0]
+    gsize = max(1, min(int(1.0 / min_d), int(math.sqrt(n_max))))
+    head = np.full((gsize, gsize), -1, dtype=np.int32)
+    nxt = np.empty(n_max, dtype=np.int32)
+    min_d2 = min_d * min_d
+    for idx in range(n_fixed):
+        gx = min(int(pts[idx, 0] * gsize), gsize - 1)
+        gy = min(int(pts[idx, 1] * gsize), gsize - 1)
+        nxt[idx] = head[gx, gy]
+        head[gx, gy] = idx
+
+    n = n_fixed
+    n_rejected = 0
+    while n < n_max and n_rejected < max_tries:
+        draws = _sampler_random.random((256, 2))
+        for cand_idx in range(256):
+            cx = draws[cand_idx, 0]
+            cy = draws[cand_idx, 1]
+            gx = min(int(cx * gsize), gsize - 1)
+            gy = min(int(cy * gsize), gsize - 1)
+            if _any_within(pts, head, nxt, gx, gy, cx, cy, min_d2):
+                n_rejected += 1
+                if n_rejected == max_tries:
+                    break
+                continue
+            pts[n, 0] = cx
+            pts[n, 1] = cy
+            nxt[n] = head[gx, gy]
+            head[gx, gy] = n
+            n += 1
+            if n == n_max:
+                break
+    return n
+
+def _throw_darts_batched(pts, n_fixed, min_d, rng, max_tries):
+    """
+    NumPy version of _throw_darts for when numba is not installed, which would run it as a slow scalar loop.
+    Each batch of candidates is checked at once against the placed points with a cKDTree. Candidates that lie
+    too close to an earlier candidate of the same batch are rejected as well.
+    """
+    n_max = len(pts)
+    n = n_fixed
+    n_rejected = 0
+    while n < n_max and n_rejected < max_tries:
+        cands = rng.random((max(n_max - n, 64), 2))
+        fits = np.ones(len(cands), dtype=bool)
+        if n > 0:
+            fits = cKDTree(pts[:n]).query(cands, distance_upper_bound=min_d)[0] >= min_d
+        pairs = cKDTree(cands).query_pairs(min_d, output_type='ndarray')
+        fits[pairs.max(axis=1)] = False
+        n_rejected += np.count_nonzero(~fits)
+        accepted = cands[fits][:n_max - n]
+        pts[n:n + len(accepted)] = accepted
+        n += len(accepted)
+    return n
+
+def _spread_points(pts, n, min_d, rng, tries_factor = 30):
+    """
+    Returns pts extended with up to n new points that are uniformly distributed over the unit square
+    and at least min_d apart from each other and from pts, see _throw_darts.
+    Fewer points are added if the square fills up: sampling stops after n * tries_factor rejected candidates.
+    """
+    all_pts = np.empty((len(pts) + n, 2))
+    all_pts[:len(pts)] = pts
+    if _throw_darts_aot is not None:
+        n_filled = _throw_darts_aot(all_pts, len(pts), min_d, rng.integers(2 ** 31), n * tries_factor)
+    elif _have_numba:
+        n_filled = _throw_darts(all_pts, len(pts), min_d, rng.integers(2 ** 31), n * tries_factor)
+    else:
+        n_filled = _throw_darts_batched(all_pts, len(pts), min_d, rng, n * tries_factor)
+    return all_pts[:n_filled]
+
+def _find_spare_positions(n, spare_pts, target_pts, range2, batch_factor = 30):
+    """
+    Selects n of the spare positions whose squared distance to at least one of the target points is at most range2.
+    Spare positions are checked in order, in batches of n * batch_factor at a time.
+    Returns the indices of the selected positions or None if there are not enough of them.
+    """
+    selected = []
+    batch = max(n * batch_factor, 1)
+    start = 0
+    while len(selected) < n and start < len(spare_pts):
+        in_range = cdist(spare_pts[start:start + batch], target_pts, 'sqeuclidean') <= range2
+        valid = np.flatnonzero(in_range.any(axis=1))[:n - len(selected)]
+        selected.extend(start + valid)
+        start += batch
+    if len(selected) < n:
+        return None
+    return np.array(selected, dtype=int)
+
+def _take_spare_positions(n, node_pts, spare_pts, target_pts, min_d, range2, rng):
+    """
+    Selects n of the spare positions within range of the target points, see _find_spare_positions.
+    While there are not enough of them, more spare positions are drawn that are at least min_d apart
+    from the nodes and the other spare positions.
+    Returns the selected positions and the remaining spare positions, or None for both if the square fills up first.
+    """
+    spare_idxs = _find_spare_positions(n, spare_pts, target_pts, range2)
+    while spare_idxs is None:
+        n_old = len(node_pts) + len(spare_pts)
+        all_pts = _spread_points(np.concatenate((node_pts, spare_pts)), max(n, len(spare_pts)), min_d, rng)
+        if len(all_pts) == n_old:
+            return None, None
+        spare_pts = all_pts[len(node_pts):]
+        spare_idxs = _find_spare_positions(n, spare_pts, target_pts, range2)
+    return spare_pts[spare_idxs], np.delete(spare_pts, spare_idxs, axis=0)
 
 def generate_problem_file(filepath, services, locations, points, service_range_factor = 1.0, do_draw = False):
     """
@@ -37,80 +208,49 @@ def generate_problem_file(filepath, services, locations, points, service_range_f
         
     # Create an initial graph. Give some slack with demand points so we can remove enough later.
     # Points are generated inside the unit square using the Poisson disk method.
+    rng = _rng
     total_nodes = locations + points
     service_range = service_range_factor / (locations ** (1.0 / 3.0))
     minimum_distance = 0.1 * service_range
-    coords = {}
-    node_idx = 0
-    while node_idx < total_nodes:
-       new_coord = (np.random.random(), np.random.random())
-       too_close = False
-       for c in coords.values():
-         if distance(c, new_coord) < minimum_distance:
-           too_close = True
-           break;
-       if too_close:
-          continue
-       coords[node_idx] = new_coord
-       node_idx += 1
-
-    G = nx.random_geometric_graph(total_nodes, service_range, pos=coords)
-
-    for loc_idx in range(locations):
-        for loc_jdx in range(locations):
-            if G.has_edge(loc_idx, loc_jdx):
-                G.remove_edge(loc_idx, loc_jdx)
-    # Remove edges between every two demand points
-    for dem_idx in range(locations, total_nodes):
-        for dem_jdx in range(locations, total_nodes):
-            if G.has_edge(dem_idx, dem_jdx):
-                G.remove_edge(dem_idx, dem_jdx)
+    # Distances are compared squared to avoid taking square roots
+    range2 = service_range ** 2
+    # Sample some spare positions along with the nodes, they keep the minimum distance to all nodes
+    # and are used to move isolated nodes. More are drawn later if these run out.
+    sampled_pts = _spread_points(np.empty((0, 2)), total_nodes + total_nodes // 4, minimum_distance, rng)
+    if len(sampled_pts) < total_nodes:
+        print("Error: only " + str(len(sampled_pts)) + " nodes fit in the unit square at the minimum distance. Exiting.")
+        exit()
+    pts = sampled_pts[:total_nodes]
+    spare_pts = sampled_pts[total_nodes:]
+
+    loc_pts = pts[:locations]
+    dem_pts = pts[locations:]
+
+    # Only location - demand point edges are needed, so compute just that part of the distance matrix
+    # Each edge is a (location, demand point) index pair
+    edges = np.argwhere(cdist(loc_pts, dem_pts, 'sqeuclidean') <= range2)
     # Move isolated demand points so they can be serviced by at least one service location
-    for dem_idx in range(locations, total_nodes):
-        node = G.node[dem_idx]
-        while len(G[dem_idx]) == 0:
-            # change the node position
-            too_close = True
-            new_coord = None
-            while too_close:
-               new_coord = (np.random.random(), np.random.random())
-               too_close = False
-               for c in coords.values():
-                 if distance(c, new_coord) < minimum_distance:
-                   too_close = True
-                   break;
-            coords[dem_idx] = new_coord
-            node['pos'] = new_coord
-            # update neighbors
-            for loc_idx in range(locations):
-                dstc = distance(G.node[loc_idx]['pos'], new_coord)
-                if dstc <= service_range:
-                    G.add_edge(loc_idx, dem_idx)
-    for loc_idx in range(locations):
-        node = G.node[loc_idx]
-        while len(G[loc_idx]) == 0:
-            # change the node position
-            too_close = True
-            new_coord = None
-            while too_close:
-               new_coord = (np.random.random(), np.random.random())
-               too_close = False
-               for c in coords.values():
-                 if distance(c, new_coord) < minimum_distance:
-                   too_close = True
-                   break;
-            coords[loc_idx] = new_coord
-            node['pos'] = new_coord
-            # update neighbors
-            for dem_idx in range(locations, total_nodes):
-                dstc = distance(G.node[dem_idx]['pos'], new_coord)
-                if dstc <= service_range:
-                    G.add_edge(loc_idx, dem_idx)
-    degree_centralities = nx.degree_centrality(G)
-    max_centrality = 0.0
-    for loc_idx in range(locations):
-        if degree_centralities[loc_idx] > max_centrality:
-            max_centrality = degree_centralities[loc_idx]
+    isolated = np.flatnonzero(np.bincount(edges[:, 1], minlength=points) == 0)
+    moved_pts, spare_pts = _take_spare_positions(len(isolated), pts, spare_pts, loc_pts, minimum_distance, range2, rng)
+    if moved_pts is None:
+        print("Error: no positions left to move isolated nodes to. Exiting.")
+        exit()
+    dem_pts[isolated] = moved_pts
+    new_edges = np.argwhere(cdist(loc_pts, dem_pts[isolated], 'sqeuclidean') <= range2)
+    new_edges[:, 1] = isolated[new_edges[:, 1]]
+    edges = np.concatenate((edges, new_edges))
+    # Move isolated service locations so they can service at least one demand point
+    isolated = np.flatnonzero(np.bincount(edges[:, 0], minlength=locations) == 0)
+    moved_pts, spare_pts = _take_spare_positions(len(isolated), pts, spare_pts, dem_pts, minimum_distance, range2, rng)
+    if moved_pts is None:
+        print("Error: no positions left to move isolated nodes to. Exiting.")
+        exit()
+    loc_pts[isolated] = moved_pts
+    new_edges = np.argwhere(cdist(loc_pts[isolated], dem_pts, 'sqeuclidean') <= range2)
+    new_edges[:, 0] = isolated[new_edges[:, 0]]
+    edges = np.concatenate((edges, new_edges))
+    loc_degrees = np.bincount(edges[:, 0], minlength=locations)
+    max_centrality = loc_degrees.max() / (total_nodes - 1)
     # Centrality = fraction of all nodes (including service points) to which a service point is connected
     print("Highest centrality: " + str(max_centrality))
     if max_centrality > 0.5:
@@ -119,6 +259,11 @@ def generate_problem_file(filepath, services, locations, points, service_range_f
         print("Warning: location with most demand points can service only " + str(math.floor(100 * max_centrality)) + " percent of demand points.")
 
     if do_draw == True:
+        # the edge array holds all connectivity, a networkx graph is only needed for drawing
+        G = nx.Graph()
+        G.add_nodes_from(range(total_nodes))
+        G.add_edges_from((int(loc_idx), int(point_idx) + locations) for loc_idx, point_idx in edges)
+        coords = {i: tuple(pts[i]) for i in range(total_nodes)}
         plt.figure(figsize=(6, 6))
         nx.draw_networkx_nodes(G, coords, nodelist = [idx for idx in range(locations)], node_size = 30, node_color = 'r')
         nx.draw_networkx_nodes(G, coords, nodelist = [idx for idx in range(locations, total_nodes)], node_size = 15, node_color = 'b')
@@ -131,48 +276,37 @@ def generate_problem_file(filepath, services, locations, points, service_range_f
     to assign each demand point a random service, ensuring that each service is
     requested at least once. We thus iterate over the demand points and sort at the end.
     """
-    services_list = []
-    locations_list = []
-    points_list = []
-    service_requested = 0
-    all_services_requested = False
-    # first `locations` indices are service locations
-    # iterate over demand point indices only
-    for dem_idx in range(locations, total_nodes):
-        locs = G[dem_idx].keys() # locations connected to current demand point
-        for loc in locs:
-            # append triplet
-            services_list.append(service_requested)
-            locations_list.append(loc)
-            points_list.append(dem_idx - locations)
-        if not all_services_requested:
-            if service_requested == services - 1:
-                all_services_requested = True
-            else:
-                service_requested += 1
-        else:
-            service_requested = np.random.randint(services)
+    edges = edges[np.argsort(edges[:, 1], kind='stable')]
+    edge_counts = np.bincount(edges[:, 1], minlength=points) # number of locations per demand point
+    # the first `services` demand points request every service once, the others a random one
+    service_per_point = rng.integers(services, size=points)
+    service_per_point[:services] = np.arange(services)
 
     data = pd.DataFrame()
-    data['service'] = services_list
-    data['location'] = locations_list
-    data['point'] = points_list
+    data['service'] = np.repeat(service_per_point, edge_counts)
+    data['location'] = edges[:, 0]
+    data['point'] = np.repeat(np.arange(points), edge_counts)
     sorted_data = data.sort_values(by=['service', 'location', 'point']).reset_index(drop=True)
 
     # opening cost range
     ocr = [4000, 5000]
-    opening_costs_list = (ocr[0] + (ocr[1] - ocr[0]) * np.random.random_sample(locations)).astype(int)
+    opening_costs_list = (ocr[0] + (ocr[1] - ocr[0]) * rng.random(locations)).astype(int)
     # equipping cost range
     ecr = [200, 500]
-    equip_costs_list = (ecr[0] + (ecr[1] - ecr[0]) * np.random.random_sample(services)).astype(int)
+    equip_costs_list = (ecr[0] + (ecr[1] - ecr[0]) * rng.random(services)).astype(int)
     data_equip = pd.DataFrame()
     data_equip['equip_costs'] = equip_costs_list
     data_open = pd.DataFrame()
     data_open['opening_costs'] = opening_costs_list
     final_data = pd.concat([sorted_data, data_open, data_equip], axis = 1)
+    # concat pads the shorter cost columns with NaN, which would make them floats
+    final_data = final_data.astype({'opening_costs': 'Int64', 'equip_costs': 'Int64'})
     
     print(filepath)
-    final_data.to_excel(filepath, sheet_name='problem', index=False)
+    if filepath.endswith('.csv'):
+        final_data.to_csv(filepath, index=False)
+    else:
+        final_data.to_excel(filepath, sheet_name='problem', index=False, engine=_excel_engine)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser( \
@@ -184,7 +318,13 @@ if __name__ == '__main__':
     parser.add_argument('--draw', default=False)
     parser.add_argument('--dir', default='.')
     parser.add_argument('--filename', default='')
+    parser.add_argument('--seed', type=int, default=None)
     args = parser.parse_args()
+    _rng = np.random.default_rng(args.seed)
+    if _have_numba and _throw_darts_aot is None:
+        # compile the sampler up front so the JIT latency is not part of the problem generation
+        # the argument types match those passed by _spread_points, so numba compiles the same specialization
+        _throw_darts(np.empty((1, 2)), 0, 0.1, 0, 30)
 
     filename = args.filename
     if len(filename) == 0: